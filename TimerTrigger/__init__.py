@@ -27,5 +27,5 @@ def main(mytimer: func.TimerRequest) -> None:
 async def run_pipeline():
     # Use same code logic as your Dockerized script
     init_db()
-    await fetch_instana_events()
-    process_all_events()
+    new_rows = await fetch_instana_events()
+    await process_all_events(new_rows)
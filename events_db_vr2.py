@@ -1,11 +1,18 @@
+import io
 import os
 import json
 import time
-import requests
+import weakref
+import aiohttp
+import ijson
+import orjson
 import psycopg2
 import asyncio
-from datetime import datetime
-from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain, islice
+from psycopg2.pool import ThreadedConnectionPool
 import lib.commonutility as common
 
 # ---------------- CONFIG & LOGGING ----------------
@@ -23,36 +30,112 @@ logger = common.setup_logger()
 logger.info("Starting Instana to BHOM event processing...")
 
 # ---------------- UTILITY FUNCTIONS ----------------
-async def create_epoc_time():
-    curr_dt = datetime.now()
-    timestamp = int(round(curr_dt.timestamp())) * 1000
-    return timestamp
-
-def get_db_connection():
-    return psycopg2.connect(
-        host=config["postgres"]["host"],
-        database=config["postgres"]["database"],
-        user=config["postgres"]["user"],
-        password=config["postgres"]["password"],
-        port=config["postgres"]["port"]
-    )
+_DB_POOL = None
+
+def get_db_pool():
+    # Created on first use and kept for the life of the worker, so timer runs reuse connections
+    global _DB_POOL
+    if _DB_POOL is None:
+        # minconn covers the two connections a run holds at once (cursor + status writes);
+        # the pool closes any connection returned beyond minconn
+        _DB_POOL = ThreadedConnectionPool(
+            2, 8,
+            host=config["postgres"]["host"],
+            database=config["postgres"]["database"],
+            user=config["postgres"]["user"],
+            password=config["postgres"]["password"],
+            port=config["postgres"]["port"]
+        )
+    return _DB_POOL
+
+# Pooled connections that already have the session temp table used by update_event_status
+_PREPARED_CONNECTIONS = weakref.WeakSet()
+
+def _checkout_connection(pool):
+    conn = pool.getconn()
+    try:
+        # An idle pooled connection may have been dropped by the server; probe it before use.
+        # A new connection is probed by creating its status-update temp table
+        with conn.cursor() as cur:
+            if conn in _PREPARED_CONNECTIONS:
+                cur.execute("SELECT 1;")
+            else:
+                cur.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS upd_event_ids (
+                        event_id TEXT
+                    ) ON COMMIT DELETE ROWS;
+                """)
+        conn.commit()
+        _PREPARED_CONNECTIONS.add(conn)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        pool.putconn(conn, close=True)
+        raise
+    return conn
+
+@contextmanager
+def db_connection():
+    pool = get_db_pool()
+    # The pool holds at most minconn idle connections, so once those are discarded
+    # the last attempt always opens a fresh one
+    for attempt in range(pool.minconn + 1):
+        try:
+            conn = _checkout_connection(pool)
+            break
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if attempt == pool.minconn:
+                raise
+            logger.warning(f"Discarding broken pooled DB connection, reconnecting: {e}")
+    try:
+        yield conn
+    finally:
+        # The pool rolls back anything left uncommitted before reusing the connection
+        pool.putconn(conn)
 
 def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS instana_events (
+                id SERIAL PRIMARY KEY,
+                event_id TEXT UNIQUE,
+                event_json JSONB,
+                status TEXT DEFAULT 'RECEIVED',
+                created_at TIMESTAMP DEFAULT NOW(),
+                updated_at TIMESTAMP DEFAULT NOW()
+            );
+        """)
+        conn.commit()
+        cur.close()
+
+def copy_text_field(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def copy_json_field(value):
+    # Compact orjson output never contains raw tabs/newlines; only backslashes need escaping for COPY
+    return orjson.dumps(value).replace(b"\\", b"\\\\")
+
+def update_event_status(cur, event_ids, status, copy_threshold=1000):
+    if len(event_ids) <= copy_threshold:
+        # Small batches: bind the ids as a single array parameter
+        cur.execute("""
+            UPDATE instana_events
+            SET status = %s, updated_at = NOW()
+            WHERE event_id = ANY(%s);
+        """, (status, event_ids))
+        return
+
+    # Large batches: COPY the ids into the session temp table created at checkout
+    # (see _checkout_connection) and join once; rows are cleared on commit
+    buf = io.StringIO("".join(f"{copy_text_field(ev_id)}\n" for ev_id in event_ids))
+    cur.copy_expert("COPY upd_event_ids FROM STDIN WITH (FORMAT text)", buf)
     cur.execute("""
-        CREATE TABLE IF NOT EXISTS instana_events (
-            id SERIAL PRIMARY KEY,
-            event_id TEXT UNIQUE,
-            event_json JSONB,
-            status TEXT DEFAULT 'RECEIVED',
-            created_at TIMESTAMP DEFAULT NOW(),
-            updated_at TIMESTAMP DEFAULT NOW()
-        );
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
+        UPDATE instana_events AS i
+        SET status = %s, updated_at = NOW()
+        FROM upd_event_ids AS u
+        WHERE i.event_id = u.event_id;
+    """, (status,))
 
 # ---------------- CUSTOM MAPPERS ----------------
 def severity_level(sev):
@@ -70,52 +153,82 @@ CUSTOM_FUNCTIONS = {
     "priority_from_severity": priority_from_severity,
 }
 
-def insert_nested_key(d, dotted_key, value):
-    keys = dotted_key.split(".")
-    for key in keys[:-1]:
-        d = d.setdefault(key, {})
-    d[keys[-1]] = value
+_REVERSE_MAP = {
+    "severity": "severity",
+    "status": "state",
+    "priority": "severity",
+    "class_slots.pn_severity": "severity"
+}
 
 def bhom_mapping_reverse_lookup(field):
-    reverse_map = {
-        "severity": "severity",
-        "status": "state",
-        "priority": "severity",
-        "class_slots.pn_severity": "severity"
-    }
-    return reverse_map.get(field, field)
+    return _REVERSE_MAP.get(field, field)
 
-def get_nested_value(data, key_path):
+@lru_cache(maxsize=512)
+def parse_key_path(key_path):
+    # "metrics[0].entityId.host" -> ("metrics", 0, "entityId", "host")
+    path = []
+    for part in key_path.replace("]", "").split("."):
+        if "[" in part:
+            key, idx = part.split("[")
+            path.extend((key, int(idx)))
+        else:
+            path.append(part)
+    return tuple(path)
+
+def get_nested_value(data, path):
     try:
-        parts = key_path.replace("]", "").split(".")
         val = data
-        for part in parts:
-            if "[" in part:
-                key, idx = part.split("[")
-                val = val[key][int(idx)]
-            else:
-                val = val[part]
+        for key in path:
+            val = val[key]
         return val
     except (KeyError, IndexError, TypeError):
         return None
 
-def resolve_bhom_mapping(event_data, mapping_config):
-    payload = {}
+def _compile_rule(bhom_field, rule):
+    if rule.startswith("static:"):
+        return "static", rule.split("static:")[1]
+    if rule.startswith("event_data:"):
+        keys = rule.split("event_data:")[1].split("|")
+        return "event_data", [parse_key_path(key.strip()) for key in keys]
+    if rule.startswith("func:"):
+        func_name = rule.split("func:")[1].strip()
+        source_path = parse_key_path(bhom_mapping_reverse_lookup(bhom_field))
+        return "func", (CUSTOM_FUNCTIONS.get(func_name, lambda x: ""), source_path)
+    return "static", ""
+
+def _build_plan(tree):
+    return [
+        (key, "nested", _build_plan(entry)) if isinstance(entry, dict) else (key, *entry)
+        for key, entry in tree.items()
+    ]
+
+def compile_mapping(mapping_config):
+    # Dotted BHOM fields (e.g. class_slots.*) are bucketed under their prefix up front
+    tree = {}
     for bhom_field, rule in mapping_config.items():
-        if rule.startswith("static:"):
-            value = rule.split("static:")[1]
-        elif rule.startswith("event_data:"):
-            keys = rule.split("event_data:")[1].split("|")
-            value = next((get_nested_value(event_data, key.strip()) for key in keys if get_nested_value(event_data, key.strip()) is not None), "")
-        elif rule.startswith("func:"):
-            func_name = rule.split("func:")[1].strip()
-            source_key = bhom_mapping_reverse_lookup(bhom_field)
-            raw_value = get_nested_value(event_data, source_key)
-            value = CUSTOM_FUNCTIONS.get(func_name, lambda x: "")(raw_value)
-        else:
-            value = ""
-        insert_nested_key(payload, bhom_field, value)
-    return [payload]
+        *parents, leaf = bhom_field.split(".")
+        node = tree
+        for key in parents:
+            node = node.setdefault(key, {})
+        node[leaf] = _compile_rule(bhom_field, rule)
+    return _build_plan(tree)
+
+def _resolve_value(event_data, kind, rule):
+    if kind == "event_data":
+        for path in rule:
+            found = get_nested_value(event_data, path)
+            if found is not None:
+                return found
+        return ""
+    if kind == "func":
+        func, source_path = rule
+        return func(get_nested_value(event_data, source_path))
+    if kind == "nested":
+        return resolve_bhom_mapping(event_data, rule)
+    return rule
+
+def resolve_bhom_mapping(event_data, plan):
+    return {field: _resolve_value(event_data, kind, rule) for field, kind, rule in plan}
 
 # ---------------- FETCH MODULE ----------------
 async def fetch_instana_events():
@@ -124,7 +237,7 @@ async def fetch_instana_events():
         'Accept': 'application/json'
     }
     url = config["instana"]["url"]
-    epoc_time = await create_epoc_time()
+    epoc_time = int(time.time() * 1000)
     payload = json.dumps({
         "timeFrame": {
             "windowSize": config['instana']['window_size'],
@@ -133,109 +246,209 @@ async def fetch_instana_events():
     })
 
     try:
-        response = requests.get(url, headers=headers, data=payload)
-        response.raise_for_status()
-        events = response.json()
-        conn = get_db_connection()
-        cur = conn.cursor()
-        print(f"Fetched {len(events)} events from Instana.")
-
-        open_events = [ev for ev in events if ev["state"] == "open"]
-        # for event in open_events:
-        #     event_id = event.get("eventId")
-        #     cur.execute("""
-        #         INSERT INTO instana_events (event_id, event_json, status)
-        #         VALUES (%s, %s, 'RECEIVED')
-        #         ON CONFLICT (event_id) DO NOTHING;
-        #     """, (event_id, json.dumps(event)))
-        #     logger.info(f"Fetched and stored event: {event_id}")
-        open_events_data = [
-            (event.get("eventId"), json.dumps(event), "RECEIVED")
-            for event in open_events
-        ]
-
-        execute_values(
-            cur,
-            """
-            INSERT INTO instana_events (event_id, event_json, status)
-            VALUES %s
-            ON CONFLICT (event_id) DO NOTHING;
-            """,
-            open_events_data
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        logger.info(f"Fetched and stored {len(open_events_data)} events.")
+        # Stream-parse the response and keep only open events, serialized straight into the COPY buffer
+        buf = io.BytesIO()
+        events_by_id = {}
+        fetched_count = 0
+        with common.SESSION.get(url, headers=headers, data=payload, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            for event in ijson.items(response.raw, "item", use_float=True):
+                fetched_count += 1
+                if event.get("state") != "open":
+                    continue
+                event_id = event.get("eventId")
+                # Stage only the first copy of a repeated eventId so the stored row and
+                # the payload posted from memory are the same event
+                if event_id in events_by_id:
+                    continue
+                events_by_id[event_id] = event
+                buf.write(copy_text_field(event_id).encode())
+                buf.write(b"\t")
+                buf.write(copy_json_field(event))
+                buf.write(b"\tRECEIVED\n")
+        print(f"Fetched {fetched_count} events from Instana.")
+        buf.seek(0)
+
+        with db_connection() as conn:
+            cur = conn.cursor()
+            # Bulk load via COPY into a staging table, then merge so duplicates are skipped
+            cur.execute("""
+                CREATE TEMP TABLE stg_instana_events (
+                    event_id TEXT,
+                    event_json JSONB,
+                    status TEXT
+                ) ON COMMIT DROP;
+            """)
+            cur.copy_expert("COPY stg_instana_events FROM STDIN WITH (FORMAT text)", buf)
+            cur.execute("""
+                INSERT INTO instana_events (event_id, event_json, status)
+                SELECT event_id, event_json, status FROM stg_instana_events
+                ON CONFLICT (event_id) DO NOTHING
+                RETURNING event_id;
+            """)
+            # Only rows this run actually inserted are handed on, so nothing is double-sent
+            new_rows = [(ev_id, events_by_id[ev_id]) for (ev_id,) in cur.fetchall()]
+            conn.commit()
+            cur.close()
+        logger.info(f"Fetched and stored {len(new_rows)} events.")
+        return new_rows
     except Exception as e:
         logger.error(f"Error fetching events: {e}")
+        return []
 
 # ---------------- PROCESSING MODULE (BATCHED) ----------------
-def process_events_in_batches(events, batch_size=8500):
-    bhom_config = dict(config["bhom_event_mapping"])
+# Coalesces serialized events into a JSON array body; flushes on max_items or max_bytes
+class BHOMBuffer:
+    def __init__(self, on_flush, max_items=8500, max_bytes=4_000_000):
+        self.on_flush = on_flush
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._reset()
+
+    def _reset(self):
+        self._event_ids = []
+        self._body = bytearray(b"[")
+
+    async def add(self, event_id, payload):
+        # Flush first if this event would push the body past the byte limit
+        if self._event_ids and len(self._body) + len(payload) + 2 > self.max_bytes:
+            await self.flush()
+
+        if self._event_ids:
+            self._body.extend(b",")
+        self._body.extend(payload)
+        self._event_ids.append(event_id)
+
+        if len(self._event_ids) >= self.max_items or len(self._body) + 1 >= self.max_bytes:
+            await self.flush()
+
+    async def flush(self):
+        if not self._event_ids:
+            return
+
+        event_ids = self._event_ids
+        self._body.extend(b"]")
+        body = bytes(self._body)
+        self._reset()
+        await self.on_flush(event_ids, body)
+
+    async def close(self):
+        await self.flush()
+
+def map_event_chunk(events, plan, chunk_size):
+    return [
+        (ev_id, orjson.dumps(resolve_bhom_mapping(ev_json, plan)))
+        for ev_id, ev_json in islice(events, chunk_size)
+    ]
+
+async def process_events_in_batches(events, conn, batch_size=8500, max_concurrency=8, map_chunk_size=500):
+    # events may be any iterable (e.g. a server-side cursor); it is consumed incrementally
+    events = iter(events)
+    first_event = next(events, None)
+    if first_event is None:
+        return
+
+    bhom_plan = compile_mapping(config["bhom_event_mapping"])
     bhom_url = config["bhom"]["url"]
     REFRESH_TOKEN_FILE = "/tmp/bhom_refresh_token.json"
     REFRESH_API_URL = config["bhom"]["refresh_api_url"]
 
-    refresh_token = common.get_valid_refresh_token(REFRESH_TOKEN_FILE, REFRESH_API_URL)
+    refresh_token = common.get_valid_refresh_token_cached(REFRESH_TOKEN_FILE, REFRESH_API_URL, config)
     headers = {
         "Authorization": f"Bearer {refresh_token}",
         "Content-Type": "application/json"
     }
 
-    conn = get_db_connection()
     cur = conn.cursor()
+    # One shared connection for status write-back, serialized across batch tasks
+    db_lock = asyncio.Lock()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = []
 
-    for i in range(0, len(events), batch_size):
-        batch = events[i:i + batch_size]
-        batch_payload = [resolve_bhom_mapping(ev_json, bhom_config)[0] for _, ev_json in batch]
-        event_ids = [ev_id for ev_id, _ in batch]
-
+    async def handle_batch(session, event_ids, body):
         try:
-            response = requests.post(bhom_url, headers=headers, json=batch_payload)
-            if response.status_code == 200:
-                resp_json = response.json()
-                resource_count = len(resp_json.get("resourceId", []))
-                if resource_count != len(batch):
-                    logger.error(f"BHOM creation count mismatch for batch starting with event {event_ids[0]}: "
-                                 f"Sent {len(batch)}, Created {resource_count}")
-                    cur.executemany("UPDATE instana_events SET status='FAILED', updated_at=NOW() WHERE event_id=%s;",
-                                    [(ev_id,) for ev_id in event_ids])
-                else:
-                    cur.executemany("UPDATE instana_events SET status='CREATED', updated_at=NOW() WHERE event_id=%s;",
-                                    [(ev_id,) for ev_id in event_ids])
-                    logger.info(f"Successfully processed batch of {len(batch)} events starting with {event_ids[0]}")
-            else:
-                logger.error(f"BHOM API Error for batch starting with {event_ids[0]}: {response.status_code}, {response.text}")
-                cur.executemany("UPDATE instana_events SET status='FAILED', updated_at=NOW() WHERE event_id=%s;",
-                                [(ev_id,) for ev_id in event_ids])
-        except Exception as e:
-            logger.error(f"Exception while processing batch starting with {event_ids[0]}: {e}")
-            cur.executemany("UPDATE instana_events SET status='FAILED', updated_at=NOW() WHERE event_id=%s;",
-                            [(ev_id,) for ev_id in event_ids])
+            status = "FAILED"
+            try:
+                async with session.post(bhom_url, headers=headers, data=body) as response:
+                    if response.status == 200:
+                        resp_json = await response.json(content_type=None)
+                        resource_count = len(resp_json.get("resourceId", []))
+                        if resource_count != len(event_ids):
+                            logger.error(f"BHOM creation count mismatch for batch starting with event {event_ids[0]}: "
+                                         f"Sent {len(event_ids)}, Created {resource_count}")
+                        else:
+                            status = "CREATED"
+                            logger.info(f"Successfully processed batch of {len(event_ids)} events starting with {event_ids[0]}")
+                    else:
+                        logger.error(f"BHOM API Error for batch starting with {event_ids[0]}: {response.status}, {await response.text()}")
+            except Exception as e:
+                logger.error(f"Exception while processing batch starting with {event_ids[0]}: {e}")
+
+            async with db_lock:
+                try:
+                    update_event_status(cur, event_ids, status)
+                finally:
+                    conn.commit()
         finally:
-            conn.commit()
+            semaphore.release()
 
-    cur.close()
-    conn.close()
+    try:
+        connector = aiohttp.TCPConnector(limit=max_concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def dispatch(event_ids, body):
+                # Wait for a free slot before accepting more events into the buffer
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(handle_batch(session, event_ids, body)))
 
-def process_all_events():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT event_id, event_json FROM instana_events WHERE status in ('RECEIVED','FAILED');")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+            try:
+                buffer = BHOMBuffer(dispatch, max_items=batch_size)
+                events = chain((first_event,), events)
+                loop = asyncio.get_running_loop()
+                # Row fetching and mapping run on a worker thread so in-flight posts keep
+                # progressing; the next chunk is prepared while the current one is buffered
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    pending = loop.run_in_executor(executor, map_event_chunk, events, bhom_plan, map_chunk_size)
+                    while True:
+                        chunk = await pending
+                        if not chunk:
+                            break
+                        pending = loop.run_in_executor(executor, map_event_chunk, events, bhom_plan, map_chunk_size)
+                        for ev_id, payload in chunk:
+                            await buffer.add(ev_id, payload)
+                await buffer.close()
+            finally:
+                # Every dispatched batch finishes its POST and status write before the
+                # session and cursor close, even if dispatching or another batch failed
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+    finally:
+        cur.close()
 
-    if rows:
-        process_events_in_batches(rows)
+async def process_all_events(new_rows=(), batch_size=8500):
+    # Named cursor keeps the result set server-side; status updates go through
+    # write_conn since committing read_conn would close the cursor
+    with db_connection() as read_conn, db_connection() as write_conn:
+        with read_conn.cursor(name="ev_cursor") as cur:
+            cur.itersize = batch_size
+            # Freshly fetched rows are already in memory; only re-read earlier
+            # failures and RECEIVED rows left behind by an interrupted run.
+            # A NULL in the array would make NOT ... = ANY() NULL for every row
+            cur.execute("""
+                SELECT event_id, event_json FROM instana_events
+                WHERE status = 'FAILED'
+                   OR (status = 'RECEIVED' AND NOT event_id = ANY(%s));
+            """, ([ev_id for ev_id, _ in new_rows if ev_id is not None],))
+            await process_events_in_batches(chain(new_rows, cur), conn=write_conn, batch_size=batch_size)
 
 # ---------------- MAIN ----------------
 async def main():
     init_db()
     logger.info("Starting fetch and processing cycle.")
-    await fetch_instana_events()
-    process_all_events()
+    new_rows = await fetch_instana_events()
+    await process_all_events(new_rows)
     logger.info("Cycle complete.")
 
 if __name__ == "__main__":
@@ -3,9 +3,25 @@ import json
 import logging
 import os
 import inspect
+import threading
+import time
 import requests
-from datetime import datetime
+from functools import lru_cache
 from logging.handlers import TimedRotatingFileHandler
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def create_http_session(pool_maxsize=16):
+    # Shared session so TCP/TLS connections are reused across Instana event fetches and BHOM token refreshes
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    )
+    session.mount("https://", adapter)
+    return session
+
+SESSION = create_http_session()
 
 def validate_path(path):
     if not os.path.exists(path):
@@ -16,6 +32,10 @@ def read_json_cfg(path):
     with open(path, 'r') as f:
         return json.load(f)
 
+# First characters a JSON document can start with; anything else is a plain string
+_JSON_START_CHARS = frozenset('{["-0123456789tfn')
+
+@lru_cache(maxsize=4)
 def read_config_ini(path):
     config = configparser.ConfigParser()
     config.read(path)
@@ -23,9 +43,12 @@ def read_config_ini(path):
     for section in config.sections():
         result[section] = {}
         for key, val in config[section].items():
+            if val.lstrip()[:1] not in _JSON_START_CHARS:
+                result[section][key] = val
+                continue
             try:
                 result[section][key] = json.loads(val)
-            except:
+            except ValueError:
                 result[section][key] = val
     return result
 
@@ -71,35 +94,60 @@ def setup_logger(name=None, log_dir='logs', level=logging.INFO):
 
     return logger
 
-def get_valid_refresh_token(json_path, refresh_api_url):
+TOKEN_MAX_AGE = 600
+
+def get_valid_refresh_token(json_path, refresh_api_url, config=None):
+    return _load_refresh_token(json_path, refresh_api_url, config)[0]
+
+def _load_refresh_token(json_path, refresh_api_url, config=None):
+    # Returns (token, issued_at epoch seconds)
     try:
         # Step 1: Check if file exists and is non-empty
         if not os.path.exists(json_path) or os.stat(json_path).st_size == 0:
-            return _create_new_refresh_token(json_path, refresh_api_url)
+            return _create_new_refresh_token(json_path, refresh_api_url, config), time.time()
 
         # Step 2: Try reading the token
         with open(json_path, 'r') as f:
             data = json.load(f)
 
-        last_time = datetime.strptime(data.get('time', ""), "%Y-%m-%d %H:%M:%S")
-        current_time = datetime.now()
-        diff_minutes = (current_time - last_time).total_seconds() / 60
+        # Step 3: Check if token is older than 10 mins ('time' is an epoch in seconds)
+        issued_at = int(data['time'])
+        if time.time() - issued_at > TOKEN_MAX_AGE:
+            return _create_new_refresh_token(json_path, refresh_api_url, config), time.time()
 
-        # Step 3: Check if token is older than 15 mins
-        if diff_minutes > 10:
-            return _create_new_refresh_token(json_path, refresh_api_url)
+        return data['refresh_token'], issued_at
 
-        return data['json_web_token']
-
-    except (json.JSONDecodeError, ValueError, KeyError):
+    except (json.JSONDecodeError, ValueError, TypeError, KeyError):
         # If file is malformed, regenerate
-        return _create_new_refresh_token(json_path, refresh_api_url)
+        return _create_new_refresh_token(json_path, refresh_api_url, config), time.time()
     except Exception as e:
         raise RuntimeError(f"Error handling refresh token: {e}")
 
-def _create_new_refresh_token(json_path, refresh_api_url):
+# In-process token cache shared by all callers in this worker
+_TOKEN_CACHE = {"token": None, "exp": 0}
+_TOKEN_LOCK = threading.Lock()
+
+def get_valid_refresh_token_cached(json_path, refresh_api_url, config=None, ttl=9 * 60):
+    if _TOKEN_CACHE["token"] and time.monotonic() < _TOKEN_CACHE["exp"]:
+        return _TOKEN_CACHE["token"]
+
+    with _TOKEN_LOCK:
+        # Another caller may have refreshed while we waited on the lock
+        if _TOKEN_CACHE["token"] and time.monotonic() < _TOKEN_CACHE["exp"]:
+            return _TOKEN_CACHE["token"]
+
+        # Miss: fall back to the on-disk token, which is only re-minted once it is stale.
+        # A token read from disk is cached no longer than it has left before TOKEN_MAX_AGE
+        token, issued_at = _load_refresh_token(json_path, refresh_api_url, config)
+        remaining = TOKEN_MAX_AGE - (time.time() - issued_at)
+        _TOKEN_CACHE["token"] = token
+        _TOKEN_CACHE["exp"] = time.monotonic() + min(ttl, remaining)
+        return token
+
+def _create_new_refresh_token(json_path, refresh_api_url, config=None):
     try:
-        config = read_config_ini('cfg/config.ini')
+        if config is None:
+            config = read_config_ini('cfg/config.ini')
         payload = json.dumps({
         "access_key": config["bhom"]["access_key"],
         "access_secret_key": config["bhom"]["access_secret_key"],
@@ -108,16 +156,15 @@ def _create_new_refresh_token(json_path, refresh_api_url):
         'Content-Type': 'application/json'
         }
 
-        response = requests.request("POST", refresh_api_url, headers=headers, data=payload)
+        response = SESSION.post(refresh_api_url, headers=headers, data=payload)
         response.raise_for_status()
         new_token = response.json().get("json_web_token")
 
         if not new_token:
             raise Exception("No 'refresh_token' found in API response")
 
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         data = {
-            "time": current_time,
+            "time": int(time.time()),
             "refresh_token": new_token
         }
 